@@ -4,209 +4,666 @@ AWS S3 Lifecycle Optimizer
 Identifies S3 buckets without lifecycle policies and recommends optimizations
 """
 
-import boto3
-import yaml
-import csv
+import io
 import json
 import argparse
-from datetime import datetime, timedelta
-from collections import defaultdict
+import logging
+import queue
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, deque, namedtuple
+from logging.handlers import QueueHandler, QueueListener
+from types import MappingProxyType
+
+try:
+    import orjson  # Optional: faster JSON encoding
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger('s3opt')
+
+# Byte-to-GiB/TiB conversion factors, multiplied rather than divided per bucket
+_INV_GIB = 1.0 / (1024 ** 3)
+_INV_TIB = 1.0 / (1024 ** 4)
+
+# Maximum number of metric queries CloudWatch accepts per GetMetricData call
+METRIC_DATA_MAX_QUERIES = 500
+
+# Column layout of the S3 Storage Lens CSV metrics export
+STORAGE_LENS_FIELDS = [
+    'version_number', 'configuration_id', 'report_date', 'aws_account_number',
+    'aws_region', 'storage_class', 'record_type', 'record_value', 'bucket_name',
+    'metric_name', 'metric_value'
+]
+
+# Recommendation templates; only the estimated cost depends on bucket size.
+# They are read-only and shared by every recommendation that uses them.
+GENERAL_RECOMMENDATION = MappingProxyType({
+    # General purpose: Intelligent-Tiering
+    'strategy': 'Intelligent-Tiering',
+    'transitions': (
+        MappingProxyType({'days': 30, 'storage_class': 'INTELLIGENT_TIERING'}),
+    ),
+    'cost_per_gb': 0.0025,
+    'savings_percentage': 89
+})
+
+LOG_BACKUP_RECOMMENDATION = MappingProxyType({
+    # Logs/backups: aggressive archival
+    'strategy': 'Intelligent-Tiering + Glacier',
+    'transitions': (
+        MappingProxyType({'days': 30, 'storage_class': 'INTELLIGENT_TIERING'}),
+        MappingProxyType({'days': 90, 'storage_class': 'GLACIER_IR'})
+    ),
+    'cost_per_gb': 0.004,  # Mostly Glacier
+    'savings_percentage': 83
+})
+
+ARCHIVE_RECOMMENDATION = MappingProxyType({
+    # Archives: immediate deep archive
+    'strategy': 'Deep Archive',
+    'transitions': (
+        MappingProxyType({'days': 0, 'storage_class': 'DEEP_ARCHIVE'}),
+    ),
+    'cost_per_gb': 0.00099,
+    'savings_percentage': 96
+})
+
+# Classifies a bucket name in a single match: group 1 is set for log/backup
+# buckets, group 2 for archives. Log/backup takes precedence when a name
+# contains both.
+BUCKET_CATEGORY_RE = re.compile(r'(?=.*(log|backup))|(?=.*(archive))', re.IGNORECASE)
+
+# Indexed by the matched group number (0 when nothing matched)
+RECOMMENDATION_TEMPLATES = (
+    GENERAL_RECOMMENDATION,
+    LOG_BACKUP_RECOMMENDATION,
+    ARCHIVE_RECOMMENDATION
+)
+
+# Maps a report's recommendation column back to its template
+TEMPLATES_BY_STRATEGY = {template['strategy']: template for template in RECOMMENDATION_TEMPLATES}
+
+# Audit cache TTLs used when the 'cache' config section leaves them out
+CACHE_DEFAULT_TTL_HOURS = {
+    'lifecycle_ttl_hours': 6,
+    'metrics_ttl_hours': 3
+}
+
+# Parallel put_bucket_lifecycle_configuration calls in apply mode
+APPLY_MAX_WORKERS = 16
+
+# Report columns; rows are plain tuples in this order, written with
+# csv.writer, rather than a dict per bucket
+REPORT_FIELDS = (
+    'bucket_name', 'size_gb', 'object_count', 'has_lifecycle',
+    'current_cost', 'recommendation', 'potential_savings'
+)
+ReportRow = namedtuple('ReportRow', REPORT_FIELDS)
+
+# AWS Config advanced query returning every recorded bucket's lifecycle rules
+AWS_CONFIG_LIFECYCLE_QUERY = (
+    "SELECT resourceName, supplementaryConfiguration.BucketLifecycleConfiguration "
+    "WHERE resourceType = 'AWS::S3::Bucket'"
+)
+
+def _dumps(obj):
+    """Serialize to indented JSON, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+def _error_code(error):
+    """Get the AWS error code of a failed call, or the exception type for non-AWS errors"""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') or type(error).__name__
+
+def _round_or_none(value, ndigits=2):
+    """Round a metric value, leaving unmeasured (None) values blank in reports"""
+    return None if value is None else round(value, ndigits)
 
 class S3LifecycleOptimizer:
     def __init__(self, config_file='config.yaml'):
+        # Heavy modules are imported here rather than at module load, so the
+        # CLI starts quickly for modes that never reach AWS
+        import boto3
+        import yaml
+        from botocore.config import Config as BotoConfig
+        
         with open(config_file, 'r') as f:
             self.config = yaml.safe_load(f)
         
-        self.s3_client = boto3.client('s3')
-        self.cloudwatch = boto3.client('cloudwatch')
+        # Size the connection pool for the worker fanout (the botocore default
+        # of 10 would cap concurrency) and back off adaptively on throttling
+        self._client_config = BotoConfig(
+            max_pool_connections=self.config.get('concurrency', 32) * 2,
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            tcp_keepalive=True,
+            connect_timeout=3,
+            read_timeout=15
+        )
+        # One session shares the credential resolver across all clients
+        self._session = boto3.Session()
+        self.s3_client = self._session.client('s3', config=self._client_config)
+        self.cloudwatch = self._session.client('cloudwatch', config=self._client_config)
+        
+        # Looked up once instead of per bucket
+        self._cost_per_gb = self.config['analysis']['storage_costs']['standard']
+        # Savings per GB for each recommendation template, indexed like
+        # RECOMMENDATION_TEMPLATES
+        self._savings_per_gb = tuple(
+            self._cost_per_gb - template['cost_per_gb'] for template in RECOMMENDATION_TEMPLATES
+        )
+        
+        # S3 metrics live in the bucket's own region, so CloudWatch clients
+        # are created per region on first use
+        self._cw_by_region = {}
+        
+        # Only ever used from the main thread
+        self._cache = self._open_cache()
+        
+        self._set_metric_window()
+    
+    def _set_metric_window(self):
+        """Fix the CloudWatch query window (UTC) shared by every bucket in a run"""
+        self._window_end = datetime.now(timezone.utc)
+        self._window_start = self._window_end - timedelta(days=2)
         
+    def _open_cache(self):
+        """Open the on-disk audit cache, if one is configured"""
+        cache_config = self.config.get('cache') or {}
+        if not cache_config.get('path'):
+            return None
+        
+        import sqlite3
+        conn = sqlite3.connect(cache_config['path'])
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS lifecycle '
+            '(bucket TEXT PRIMARY KEY, ts REAL NOT NULL, rules TEXT)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metrics '
+            '(bucket TEXT PRIMARY KEY, ts REAL NOT NULL, size_bytes REAL, object_count INTEGER)'
+        )
+        return conn
+    
+    def _cache_ttl(self, key):
+        """Get a cache TTL in seconds from the config, falling back to the default"""
+        cache_config = self.config.get('cache') or {}
+        return cache_config.get(key, CACHE_DEFAULT_TTL_HOURS[key]) * 3600
+    
+    def _cache_get_lifecycles(self, ttl):
+        """Get cached lifecycle rules newer than ttl seconds, keyed by bucket"""
+        if self._cache is None or ttl <= 0:
+            return {}
+        rows = self._cache.execute(
+            'SELECT bucket, rules FROM lifecycle WHERE ts >= ?', (time.time() - ttl,)
+        )
+        return {bucket: json.loads(rules) for bucket, rules in rows}
+    
+    def _cache_put_lifecycles(self, lifecycles):
+        """Store freshly fetched lifecycle rules (None for no policy)"""
+        if self._cache is None or not lifecycles:
+            return
+        now = time.time()
+        with self._cache:
+            self._cache.executemany(
+                'INSERT OR REPLACE INTO lifecycle VALUES (?, ?, ?)',
+                [(bucket, now, json.dumps(rules, default=str))
+                 for bucket, rules in lifecycles.items()]
+            )
+    
+    def _cache_get_metrics(self, ttl):
+        """Get cached (size_bytes, object_count) newer than ttl seconds, keyed by bucket"""
+        if self._cache is None or ttl <= 0:
+            return {}
+        rows = self._cache.execute(
+            'SELECT bucket, size_bytes, object_count FROM metrics WHERE ts >= ?',
+            (time.time() - ttl,)
+        )
+        return {bucket: (size_bytes, object_count) for bucket, size_bytes, object_count in rows}
+    
+    def _cache_put_metrics(self, metrics):
+        """Store freshly fetched (size_bytes, object_count) pairs"""
+        if self._cache is None or not metrics:
+            return
+        now = time.time()
+        with self._cache:
+            self._cache.executemany(
+                'INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)',
+                [(bucket, now, size_bytes, object_count)
+                 for bucket, (size_bytes, object_count) in metrics.items()]
+            )
+    
     def get_all_buckets(self):
-        """Get all S3 buckets"""
-        response = self.s3_client.list_buckets()
-        return response['Buckets']
+        """Get all S3 buckets, including each bucket's region"""
+        paginator = self.s3_client.get_paginator('list_buckets')
+        return [
+            bucket
+            for page in paginator.paginate(MaxBuckets=1000)
+            for bucket in page['Buckets']
+        ]
+    
+    def _cloudwatch_for(self, region):
+        """Get the CloudWatch client for a bucket region"""
+        if region is None or region == self.cloudwatch.meta.region_name:
+            return self.cloudwatch
+        if region not in self._cw_by_region:
+            self._cw_by_region[region] = self._session.client(
+                'cloudwatch', region_name=region, config=self._client_config
+            )
+        return self._cw_by_region[region]
     
-    def get_bucket_lifecycle(self, bucket_name):
-        """Get lifecycle configuration for a bucket"""
+    def _request_bucket_lifecycle(self, bucket_name):
+        """Get lifecycle rules (None if unset), letting API errors propagate"""
         try:
             response = self.s3_client.get_bucket_lifecycle_configuration(
                 Bucket=bucket_name
             )
             return response.get('Rules', [])
-        except self.s3_client.exceptions.NoSuchLifecycleConfiguration:
-            return None
-        except Exception as e:
-            print(f"   ⚠️  Error getting lifecycle for {bucket_name}: {e}")
+        except self.s3_client.exceptions.ClientError as e:
+            # S3 does not model NoSuchLifecycleConfiguration as its own
+            # exception class, so it is recognized by error code
+            if _error_code(e) != 'NoSuchLifecycleConfiguration':
+                raise
             return None
     
-    def get_bucket_size(self, bucket_name):
-        """Get bucket size from CloudWatch metrics"""
-        try:
-            response = self.cloudwatch.get_metric_statistics(
-                Namespace='AWS/S3',
-                MetricName='BucketSizeBytes',
-                Dimensions=[
-                    {'Name': 'BucketName', 'Value': bucket_name},
-                    {'Name': 'StorageType', 'Value': 'StandardStorage'}
-                ],
-                StartTime=datetime.now() - timedelta(days=2),
-                EndTime=datetime.now(),
-                Period=86400,
-                Statistics=['Average']
-            )
+    def _fetch_all_metrics(self, bucket_names, cloudwatch=None):
+        """Fetch size and object count for all buckets via batched GetMetricData"""
+        cloudwatch = cloudwatch or self.cloudwatch
+        queries = []
+        for i, bucket_name in enumerate(bucket_names):
+            queries.append({
+                'Id': f's{i}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/S3',
+                        'MetricName': 'BucketSizeBytes',
+                        'Dimensions': [
+                            {'Name': 'BucketName', 'Value': bucket_name},
+                            {'Name': 'StorageType', 'Value': 'StandardStorage'}
+                        ]
+                    },
+                    'Period': 86400,
+                    'Stat': 'Average'
+                }
+            })
+            queries.append({
+                'Id': f'o{i}',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/S3',
+                        'MetricName': 'NumberOfObjects',
+                        'Dimensions': [
+                            {'Name': 'BucketName', 'Value': bucket_name},
+                            {'Name': 'StorageType', 'Value': 'AllStorageTypes'}
+                        ]
+                    },
+                    'Period': 86400,
+                    'Stat': 'Average'
+                }
+            })
+        
+        # Buckets in a failed request are left out of the results, so
+        # callers can tell "no datapoints" (0) apart from "not fetched"
+        sizes = {}
+        counts = {}
+        
+        # GetMetricData accepts at most 500 queries per request
+        for offset in range(0, len(queries), METRIC_DATA_MAX_QUERIES):
+            chunk = queries[offset:offset + METRIC_DATA_MAX_QUERIES]
+            chunk_names = bucket_names[offset // 2:(offset + len(chunk)) // 2]
+            chunk_sizes = dict.fromkeys(chunk_names, 0)
+            chunk_counts = dict.fromkeys(chunk_names, 0)
+            kwargs = {
+                'MetricDataQueries': chunk,
+                'StartTime': self._window_start,
+                'EndTime': self._window_end
+            }
+            seen = set()
+            try:
+                while True:
+                    response = cloudwatch.get_metric_data(**kwargs)
+                    for result in response['MetricDataResults']:
+                        # Values are newest first, and later pages only
+                        # carry older datapoints, so the first value wins
+                        if not result['Values'] or result['Id'] in seen:
+                            continue
+                        seen.add(result['Id'])
+                        bucket_name = bucket_names[int(result['Id'][1:])]
+                        if result['Id'][0] == 's':
+                            chunk_sizes[bucket_name] = result['Values'][0]
+                        else:
+                            chunk_counts[bucket_name] = int(result['Values'][0])
+                    
+                    if 'NextToken' not in response:
+                        break
+                    kwargs['NextToken'] = response['NextToken']
+            except Exception as e:
+                logger.warning(f"   ⚠️  Error getting CloudWatch metrics: {e}")
+                continue
             
-            if response['Datapoints']:
-                size_bytes = response['Datapoints'][0]['Average']
-                return size_bytes
-            return 0
-        except Exception as e:
-            return 0
+            sizes.update(chunk_sizes)
+            counts.update(chunk_counts)
+        
+        return sizes, counts
     
-    def get_bucket_object_count(self, bucket_name):
-        """Get number of objects in bucket"""
+    def recommend_lifecycle_policy(self, bucket_name, size_bytes, object_count):
+        """Generate lifecycle policy recommendation and monthly savings for a bucket
+        
+        The recommendation is a shared template: 'transitions' is a tuple of
+        read-only mappings, so it cannot be modified and is not directly
+        JSON-serializable. Use generate_lifecycle_policy() for a plain-dict policy.
+        """
+        size_gb = size_bytes * _INV_GIB
+        
+        if size_gb < 1:
+            return None, 0  # Too small to optimize
+        
+        return self._recommend(bucket_name, size_gb)
+    
+    def _recommend(self, bucket_name, size_gb):
+        """Pick a recommendation template and price it for an already-computed size"""
+        # Determine best strategy based on bucket characteristics
+        match = BUCKET_CATEGORY_RE.match(bucket_name)
+        index = match.lastindex if match else 0
+        template = RECOMMENDATION_TEMPLATES[index]
+        # Only the size-dependent figure is new; the rest references the template
+        recommendation = {
+            'strategy': template['strategy'],
+            'transitions': template['transitions'],
+            'estimated_cost': size_gb * template['cost_per_gb'],
+            'savings_percentage': template['savings_percentage']
+        }
+        
+        # current_cost - estimated_cost, folded into one precomputed factor
+        savings = size_gb * self._savings_per_gb[index]
+        return recommendation, savings
+    
+    def _load_storage_lens_metrics(self):
+        """Load bucket size/object count from the latest Storage Lens CSV export"""
+        lens_config = self.config.get('storage_lens') or {}
+        lens_bucket = lens_config.get('bucket')
+        if not lens_bucket:
+            return None
+        
+        import csv
+        import gzip
+        
         try:
-            response = self.cloudwatch.get_metric_statistics(
-                Namespace='AWS/S3',
-                MetricName='NumberOfObjects',
-                Dimensions=[
-                    {'Name': 'BucketName', 'Value': bucket_name},
-                    {'Name': 'StorageType', 'Value': 'AllStorageTypes'}
-                ],
-                StartTime=datetime.now() - timedelta(days=2),
-                EndTime=datetime.now(),
-                Period=86400,
-                Statistics=['Average']
+            # Each daily export writes a manifest.json listing its report files
+            latest = None
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=lens_bucket, Prefix=lens_config.get('prefix', '')):
+                for obj in page.get('Contents', []):
+                    if obj['Key'].endswith('manifest.json') and (
+                            latest is None or obj['LastModified'] > latest['LastModified']):
+                        latest = obj
+            
+            if latest is None:
+                logger.warning(f"   ⚠️  No Storage Lens manifest found in s3://{lens_bucket}, using CloudWatch")
+                return None
+            
+            manifest = json.loads(
+                self.s3_client.get_object(Bucket=lens_bucket, Key=latest['Key'])['Body'].read()
             )
+            if manifest.get('reportFormat', 'CSV').upper() != 'CSV':
+                logger.warning(f"   ⚠️  Unsupported Storage Lens format {manifest['reportFormat']}, using CloudWatch")
+                return None
+            
+            sizes = defaultdict(float)
+            counts = defaultdict(int)
+            for report_file in manifest['reportFiles']:
+                body = self.s3_client.get_object(Bucket=lens_bucket, Key=report_file['key'])['Body'].read()
+                if report_file['key'].endswith('.gz'):
+                    body = gzip.decompress(body)
+                
+                reader = csv.DictReader(io.StringIO(body.decode('utf-8')), fieldnames=STORAGE_LENS_FIELDS)
+                for row in reader:
+                    if row['record_type'] != 'BUCKET':
+                        continue  # Also skips a header row, if present
+                    if row['metric_name'] == 'StorageBytes' and row['storage_class'] == 'STANDARD':
+                        sizes[row['bucket_name']] += float(row['metric_value'])
+                    elif row['metric_name'] == 'ObjectCount':
+                        counts[row['bucket_name']] += int(float(row['metric_value']))
             
-            if response['Datapoints']:
-                return int(response['Datapoints'][0]['Average'])
-            return 0
-        except Exception:
-            return 0
+            return sizes, counts
+        except Exception as e:
+            logger.warning(f"   ⚠️  Error reading Storage Lens export, using CloudWatch: {e}")
+            return None
     
-    def calculate_current_cost(self, size_bytes, storage_class='standard'):
-        """Calculate current monthly storage cost"""
-        size_gb = size_bytes / (1024 ** 3)
-        cost_per_gb = self.config['analysis']['storage_costs'][storage_class]
-        return size_gb * cost_per_gb
+    def _load_aws_config_lifecycles(self):
+        """Get lifecycle rules for all recorded buckets via an AWS Config advanced query"""
+        if not self.config.get('use_aws_config'):
+            return {}
+        
+        config_client = self._session.client('config', config=self._client_config)
+        lifecycles = {}
+        kwargs = {'Expression': AWS_CONFIG_LIFECYCLE_QUERY, 'Limit': 100}
+        try:
+            while True:
+                response = config_client.select_resource_config(**kwargs)
+                for result in response['Results']:
+                    item = json.loads(result)
+                    lifecycle = (item.get('supplementaryConfiguration') or {}).get(
+                        'BucketLifecycleConfiguration') or {}
+                    lifecycles[item['resourceName']] = lifecycle.get('rules') or None
+                
+                if 'NextToken' not in response:
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        except Exception as e:
+            logger.warning(f"   ⚠️  Error querying AWS Config, using per-bucket lookups: {e}")
+            return {}
+        
+        return lifecycles
     
-    def recommend_lifecycle_policy(self, bucket_name, size_bytes, object_count):
-        """Generate lifecycle policy recommendation"""
-        size_gb = size_bytes / (1024 ** 3)
+    def _iter_lifecycles_and_metrics(self, buckets, use_cache=True):
+        """Yield (bucket_name, lifecycle, size_bytes, object_count) as results arrive"""
+        # A configured Storage Lens export replaces CloudWatch polling entirely
+        storage_lens = self._load_storage_lens_metrics()
         
-        if size_gb < 1:
-            return None, 0  # Too small to optimize
+        # Only buckets without a lifecycle policy can get a recommendation,
+        # so CloudWatch is queried for those alone. Each full GetMetricData
+        # batch is submitted as soon as it fills up, so metric requests run
+        # alongside the remaining lifecycle lookups.
+        # Batches are kept per region, since each is sent to that region's
+        # CloudWatch endpoint.
+        buckets_per_batch = METRIC_DATA_MAX_QUERIES // 2
+        regions = {b['Name']: b.get('BucketRegion') for b in buckets}
+        pending = defaultdict(list)
+        metric_futures = {}
         
-        current_cost = self.calculate_current_cost(size_bytes, 'standard')
+        # Lifecycle configs (and CloudWatch metrics) from a recent run are
+        # served from the local cache; only misses go to AWS. Fresh results
+        # are still written back when reads are disabled.
+        lifecycle_ttl = self._cache_ttl('lifecycle_ttl_hours') if use_cache else 0
+        metrics_ttl = self._cache_ttl('metrics_ttl_hours') if use_cache else 0
+        cached_lifecycles = self._cache_get_lifecycles(lifecycle_ttl)
+        # AWS Config can supply every bucket's lifecycle in a few queries;
+        # buckets it has not recorded fall back to the per-bucket API
+        cached_lifecycles = {**self._load_aws_config_lifecycles(), **cached_lifecycles}
+        cached_metrics = self._cache_get_metrics(metrics_ttl) if storage_lens is None else {}
+        fetched_lifecycles = {}
+        fetched_metrics = {}
         
-        # Determine best strategy based on bucket characteristics
-        if 'log' in bucket_name.lower() or 'backup' in bucket_name.lower():
-            # Logs/backups: aggressive archival
-            recommendation = {
-                'strategy': 'Intelligent-Tiering + Glacier',
-                'transitions': [
-                    {'days': 30, 'storage_class': 'INTELLIGENT_TIERING'},
-                    {'days': 90, 'storage_class': 'GLACIER_IR'}
-                ],
-                'estimated_cost': size_gb * 0.004,  # Mostly Glacier
-                'savings_percentage': 83
-            }
-        elif 'archive' in bucket_name.lower():
-            # Archives: immediate deep archive
-            recommendation = {
-                'strategy': 'Deep Archive',
-                'transitions': [
-                    {'days': 0, 'storage_class': 'DEEP_ARCHIVE'}
-                ],
-                'estimated_cost': size_gb * 0.00099,
-                'savings_percentage': 96
+        # boto3 low-level clients are thread-safe, so the workers share them
+        with ThreadPoolExecutor(max_workers=self.config.get('concurrency', 32)) as executor:
+            def submit_metrics(region, batch):
+                future = executor.submit(self._fetch_all_metrics, batch, self._cloudwatch_for(region))
+                metric_futures[future] = batch
+            
+            def settle(bucket_name, lifecycle):
+                """Yield the bucket's result now if its metrics are known, else queue a query"""
+                if lifecycle is not None:
+                    yield bucket_name, lifecycle, None, None
+                elif storage_lens is not None:
+                    lens_sizes, lens_counts = storage_lens
+                    yield bucket_name, None, lens_sizes.get(bucket_name, 0), lens_counts.get(bucket_name, 0)
+                elif bucket_name in cached_metrics:
+                    yield (bucket_name, None) + tuple(cached_metrics[bucket_name])
+                else:
+                    region = regions[bucket_name]
+                    pending[region].append(bucket_name)
+                    if len(pending[region]) == buckets_per_batch:
+                        submit_metrics(region, pending.pop(region))
+            
+            def metric_results(futures):
+                """Yield the buckets of completed metric batches, remembering them for the cache"""
+                for future in futures:
+                    batch = metric_futures.pop(future)
+                    batch_sizes, batch_counts = future.result()
+                    for bucket_name in batch:
+                        if bucket_name in batch_sizes:
+                            fetched_metrics[bucket_name] = (batch_sizes[bucket_name], batch_counts[bucket_name])
+                        # Buckets from a failed request are reported as empty
+                        yield bucket_name, None, batch_sizes.get(bucket_name, 0), batch_counts.get(bucket_name, 0)
+            
+            lifecycle_futures = {
+                executor.submit(self._request_bucket_lifecycle, name): name
+                for name in regions if name not in cached_lifecycles
             }
-        else:
-            # General purpose: Intelligent-Tiering
-            recommendation = {
-                'strategy': 'Intelligent-Tiering',
-                'transitions': [
-                    {'days': 30, 'storage_class': 'INTELLIGENT_TIERING'}
-                ],
-                'estimated_cost': size_gb * 0.0025,
-                'savings_percentage': 89
+            
+            for bucket_name in regions:
+                if bucket_name in cached_lifecycles:
+                    yield from settle(bucket_name, cached_lifecycles[bucket_name])
+            
+            for future in as_completed(lifecycle_futures):
+                bucket_name = lifecycle_futures[future]
+                try:
+                    lifecycle = fetched_lifecycles[bucket_name] = future.result()
+                except Exception as e:
+                    # Left out of the cache, so the next run retries this bucket
+                    logger.warning(f"   ⚠️  Error getting lifecycle for {bucket_name}: {e}")
+                    lifecycle = None
+                
+                yield from settle(bucket_name, lifecycle)
+                
+                # Report any metric batches that finished in the meantime
+                yield from metric_results([f for f in metric_futures if f.done()])
+            
+            for region, batch in pending.items():
+                submit_metrics(region, batch)
+            
+            yield from metric_results(as_completed(list(metric_futures)))
+        
+        self._cache_put_lifecycles(fetched_lifecycles)
+        self._cache_put_metrics(fetched_metrics)
+    
+    def _analyze_one_bucket(self, bucket_name, has_lifecycle, size_bytes, object_count):
+        """Analyze a single bucket from its pre-fetched lifecycle state and metrics"""
+        if has_lifecycle:
+            # Already configured: metrics were never fetched for this bucket
+            return {
+                'bucket_name': bucket_name,
+                'size_bytes': None,
+                'size_gb': None,
+                'object_count': None,
+                'has_lifecycle': True,
+                'current_cost': None,
+                'recommendation': None,
+                'savings': 0
             }
         
-        savings = current_cost - recommendation['estimated_cost']
-        return recommendation, savings
+        size_gb = size_bytes * _INV_GIB
+        current_cost = size_gb * self._cost_per_gb
+        
+        # Generate recommendation if no lifecycle
+        recommendation = None
+        savings = 0
+        if size_gb > 1:
+            # Size is computed once per bucket and reused here
+            recommendation, savings = self._recommend(bucket_name, size_gb)
+        
+        return {
+            'bucket_name': bucket_name,
+            'size_bytes': size_bytes,
+            'size_gb': size_gb,
+            'object_count': object_count,
+            'has_lifecycle': False,
+            'current_cost': current_cost,
+            'recommendation': recommendation,
+            'savings': savings
+        }
     
-    def audit_buckets(self):
-        """Audit all S3 buckets for lifecycle policies"""
-        print("🗂️  S3 Lifecycle Optimization Audit")
-        print(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 70)
+    def audit_buckets(self, use_cache=True):
+        """Audit all S3 buckets; returns a single-pass iterator of ReportRow, one per bucket
+        
+        Buckets are listed up front, but each is only analyzed as the iterator is
+        consumed, and the summary is logged once it is exhausted. The result has
+        no len() and cannot be iterated twice; wrap it in list() to keep the rows.
+        Pass use_cache=False to skip cached lifecycle and metric rows.
+        """
+        logger.info("🗂️  S3 Lifecycle Optimization Audit\n"
+                    f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+                    + "=" * 70)
         
+        self._set_metric_window()
         buckets = self.get_all_buckets()
-        print(f"\nFound {len(buckets)} buckets")
+        logger.info(f"\nFound {len(buckets)} buckets")
         
-        audit_results = []
+        return self._iter_audit_rows(buckets, use_cache)
+    
+    def _iter_audit_rows(self, buckets, use_cache):
+        """Analyze and log each bucket as its data arrives, then log the summary"""
         total_size = 0
         total_cost = 0
         total_savings = 0
         buckets_without_lifecycle = 0
         
-        for bucket in buckets:
-            bucket_name = bucket['Name']
-            print(f"\n📦 Analyzing: {bucket_name}")
-            
-            # Get lifecycle policy
-            lifecycle = self.get_bucket_lifecycle(bucket_name)
-            has_lifecycle = lifecycle is not None
-            
-            # Get bucket metrics
-            size_bytes = self.get_bucket_size(bucket_name)
-            object_count = self.get_bucket_object_count(bucket_name)
-            size_gb = size_bytes / (1024 ** 3)
-            
-            current_cost = self.calculate_current_cost(size_bytes)
+        for bucket_name, lifecycle, size_bytes, object_count in self._iter_lifecycles_and_metrics(buckets, use_cache):
+            result = self._analyze_one_bucket(
+                bucket_name, lifecycle is not None, size_bytes, object_count
+            )
+            recommendation = result['recommendation']
+            savings = result['savings']
             
-            print(f"   Size: {size_gb:.2f} GB")
-            print(f"   Objects: {object_count:,}")
-            print(f"   Lifecycle Policy: {'✅ Yes' if has_lifecycle else '❌ No'}")
-            print(f"   Current Cost: ${current_cost:.2f}/month")
+            # One log record per bucket rather than a write per line
+            lines = [f"\n📦 Analyzing: {bucket_name}"]
+            if result['has_lifecycle']:
+                lines.append("   Lifecycle Policy: ✅ Yes")
+            else:
+                lines.append(f"   Size: {result['size_gb']:.2f} GB")
+                lines.append(f"   Objects: {result['object_count']:,}")
+                lines.append("   Lifecycle Policy: ❌ No")
+                lines.append(f"   Current Cost: ${result['current_cost']:.2f}/month")
+                
+                total_size += result['size_bytes']
+                total_cost += result['current_cost']
             
-            # Generate recommendation if no lifecycle
-            recommendation = None
-            savings = 0
-            if not has_lifecycle and size_gb > 1:
-                recommendation, savings = self.recommend_lifecycle_policy(
-                    bucket_name, size_bytes, object_count
-                )
-                if recommendation:
-                    print(f"   💡 Recommendation: {recommendation['strategy']}")
-                    print(f"   💰 Potential Savings: ${savings:.2f}/month ({recommendation['savings_percentage']}%)")
-                    buckets_without_lifecycle += 1
-                    total_savings += savings
+            if recommendation:
+                lines.append(f"   💡 Recommendation: {recommendation['strategy']}")
+                lines.append(f"   💰 Potential Savings: ${savings:.2f}/month ({recommendation['savings_percentage']}%)")
+                buckets_without_lifecycle += 1
+                total_savings += savings
             
-            total_size += size_bytes
-            total_cost += current_cost
+            logger.info("\n".join(lines))
             
-            audit_results.append({
-                'bucket_name': bucket_name,
-                'size_gb': round(size_gb, 2),
-                'object_count': object_count,
-                'has_lifecycle': has_lifecycle,
-                'current_cost': round(current_cost, 2),
-                'recommendation': recommendation['strategy'] if recommendation else 'N/A',
-                'potential_savings': round(savings, 2)
-            })
+            yield ReportRow(
+                bucket_name,
+                _round_or_none(result['size_gb']),
+                result['object_count'],
+                result['has_lifecycle'],
+                _round_or_none(result['current_cost']),
+                recommendation['strategy'] if recommendation else 'N/A',
+                round(savings, 2)
+            )
         
         # Summary
-        print("\n" + "=" * 70)
-        print("📊 Summary")
-        print("=" * 70)
-        print(f"Total Buckets: {len(buckets)}")
-        print(f"Buckets without Lifecycle: {buckets_without_lifecycle}")
-        print(f"Total Storage: {total_size / (1024**4):.2f} TB")
-        print(f"Current Monthly Cost: ${total_cost:.2f}")
-        print(f"Potential Monthly Savings: ${total_savings:.2f}")
-        print(f"Potential Annual Savings: ${total_savings * 12:.2f}")
-        
-        return audit_results
+        logger.info("\n".join([
+            "\n" + "=" * 70,
+            "📊 Summary",
+            "=" * 70,
+            f"Total Buckets: {len(buckets)}",
+            f"Buckets without Lifecycle: {buckets_without_lifecycle}",
+            f"Storage without Lifecycle: {total_size * _INV_TIB:.2f} TB",
+            f"Current Monthly Cost (without Lifecycle): ${total_cost:.2f}",
+            f"Potential Monthly Savings: ${total_savings:.2f}",
+            f"Potential Annual Savings: ${total_savings * 12:.2f}"
+        ]))
     
     def generate_lifecycle_policy(self, recommendation):
         """Generate S3 lifecycle policy JSON"""
@@ -214,7 +671,8 @@ class S3LifecycleOptimizer:
         
         for i, transition in enumerate(recommendation['transitions']):
             rule = {
-                'Id': f'OptimizationRule{i+1}',
+                'ID': f'OptimizationRule{i+1}',
+                'Filter': {'Prefix': ''},  # Whole bucket
                 'Status': 'Enabled',
                 'Transitions': [
                     {
@@ -228,59 +686,177 @@ class S3LifecycleOptimizer:
         return {'Rules': rules}
     
     def apply_lifecycle_policy(self, bucket_name, policy, dry_run=True):
-        """Apply lifecycle policy to bucket"""
+        """Apply lifecycle policy to a bucket that has none; returns (ok, error_code)"""
+        # PutBucketLifecycleConfiguration replaces the whole configuration, so
+        # first confirm live (never from the cache or AWS Config) that the
+        # bucket has no policy. Any other outcome, including a failed read,
+        # leaves the bucket untouched.
+        try:
+            if self._request_bucket_lifecycle(bucket_name) is not None:
+                return False, 'LifecycleAlreadyConfigured'
+        except Exception as e:
+            return False, _error_code(e)
+        
         if dry_run:
-            print(f"[DRY RUN] Would apply policy to {bucket_name}:")
-            print(json.dumps(policy, indent=2))
-            return True
+            return True, None
         
+        # Throttling is retried with backoff by the client's adaptive retry
+        # mode; anything still failing is reported by error code
         try:
             self.s3_client.put_bucket_lifecycle_configuration(
                 Bucket=bucket_name,
                 LifecycleConfiguration=policy
             )
-            print(f"✅ Applied lifecycle policy to {bucket_name}")
-            return True
+            return True, None
         except Exception as e:
-            print(f"❌ Failed to apply policy to {bucket_name}: {e}")
-            return False
+            return False, _error_code(e)
+    
+    def apply_all(self, recommendations, dry_run=True):
+        """Apply recommended lifecycle policies to many buckets in parallel"""
+        def apply_one(item):
+            bucket_name, recommendation = item
+            policy = self.generate_lifecycle_policy(recommendation)
+            return (bucket_name, policy) + self.apply_lifecycle_policy(bucket_name, policy, dry_run)
+        
+        with ThreadPoolExecutor(max_workers=APPLY_MAX_WORKERS) as executor:
+            outcomes = list(executor.map(apply_one, recommendations))
+        
+        # Keep the audit cache from reporting applied buckets as unconfigured
+        if not dry_run:
+            self._cache_put_lifecycles({
+                bucket_name: policy['Rules']
+                for bucket_name, policy, ok, _ in outcomes if ok
+            })
+        
+        # A single summary table, plus each distinct policy body once
+        ok_label = '[DRY RUN] Would apply' if dry_run else '✅ Applied'
+        strategies = [recommendation['strategy'] for _, recommendation in recommendations]
+        width = max([len('Bucket')] + [len(bucket_name) for bucket_name, _ in recommendations])
+        strategy_width = max([len('Strategy')] + [len(strategy) for strategy in strategies])
+        lines = ["\n" + "=" * 70, "🛠️  Lifecycle Policy Changes", "=" * 70,
+                 f"{'Bucket':<{width}}  {'Strategy':<{strategy_width}}  Result"]
+        for (bucket_name, _, ok, err_code), strategy in zip(outcomes, strategies):
+            result = ok_label if ok else '❌ ' + err_code
+            lines.append(f"{bucket_name:<{width}}  {strategy:<{strategy_width}}  {result}")
+        succeeded = sum(1 for _, _, ok, _ in outcomes if ok)
+        lines.append(f"\n{succeeded}/{len(outcomes)} buckets succeeded")
+        
+        policies = {}
+        for (_, policy, _, _), strategy in zip(outcomes, strategies):
+            policies.setdefault(strategy, policy)
+        for strategy, policy in policies.items():
+            lines.append(f"\nPolicy for {strategy}:\n" + _dumps(policy))
+        logger.info("\n".join(lines))
+        
+        return [(bucket_name, ok, err_code) for bucket_name, _, ok, err_code in outcomes]
+    
+    def audit_bucket(self, bucket_name):
+        """Analyze a single bucket directly, without listing or auditing the account"""
+        self._set_metric_window()
+        region = self.s3_client.head_bucket(Bucket=bucket_name).get('BucketRegion')
+        if self._request_bucket_lifecycle(bucket_name) is not None:
+            return self._analyze_one_bucket(bucket_name, True, None, None)
+        
+        sizes, counts = self._fetch_all_metrics([bucket_name], self._cloudwatch_for(region))
+        return self._analyze_one_bucket(
+            bucket_name, False, sizes.get(bucket_name, 0), counts.get(bucket_name, 0)
+        )
     
     def export_to_csv(self, results, output_file):
-        """Export audit results to CSV"""
-        with open(output_file, 'w', newline='') as f:
-            fieldnames = ['bucket_name', 'size_gb', 'object_count', 'has_lifecycle',
-                         'current_cost', 'recommendation', 'potential_savings']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
+        """Export audit results to CSV (gzipped for .gz paths and s3:// uploads)"""
+        import csv
+        import gzip
+        
+        def write_rows(f):
+            writer = csv.writer(f)
+            writer.writerow(REPORT_FIELDS)
             writer.writerows(results)
         
-        print(f"\n✅ Report saved to {output_file}")
+        if output_file.startswith('s3://'):
+            # Compressed in memory and uploaded directly, without a temp file
+            report_bucket, _, key = output_file[len('s3://'):].partition('/')
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gz, \
+                    io.TextIOWrapper(gz, newline='', encoding='utf-8') as f:
+                write_rows(f)
+            buf.seek(0)
+            self.s3_client.upload_fileobj(
+                buf, report_bucket, key,
+                ExtraArgs={'ContentType': 'text/csv', 'ContentEncoding': 'gzip'}
+            )
+        elif output_file.endswith('.gz'):
+            with gzip.open(output_file, 'wt', newline='', encoding='utf-8') as f:
+                write_rows(f)
+        else:
+            with open(output_file, 'w', newline='') as f:
+                write_rows(f)
+        
+        logger.info(f"\n✅ Report saved to {output_file}")
+
+def configure_logging():
+    """Route report output to stdout through a queue, so callers never block on the terminal"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, handler)
+    
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
 
 def main():
     parser = argparse.ArgumentParser(description='AWS S3 Lifecycle Optimizer')
     parser.add_argument('--mode', choices=['audit', 'recommend', 'apply'],
                        required=True, help='Operation mode')
     parser.add_argument('--config', default='config.yaml', help='Config file')
-    parser.add_argument('--output', help='Output CSV file')
+    parser.add_argument('--output',
+                       help='Output CSV file (.gz to compress, s3://bucket/key to upload gzipped)')
     parser.add_argument('--bucket', help='Specific bucket name')
     parser.add_argument('--dry-run', action='store_true', help='Dry run mode')
+    parser.add_argument('--all-buckets', action='store_true',
+                       help='In apply mode, write policies to every recommended bucket in the account')
     
     args = parser.parse_args()
+    if args.mode == 'apply' and not (args.bucket or args.dry_run or args.all_buckets):
+        parser.error('--mode apply changes live buckets: pass --bucket NAME, '
+                     '--all-buckets, or --dry-run')
     
+    listener = configure_logging()
+    try:
+        run(args)
+    finally:
+        listener.stop()
+
+def run(args):
     optimizer = S3LifecycleOptimizer(config_file=args.config)
     
-    if args.mode == 'audit':
-        results = optimizer.audit_buckets()
-        if args.output:
-            optimizer.export_to_csv(results, args.output)
-    
-    elif args.mode == 'recommend':
+    if args.mode in ('audit', 'recommend'):
         results = optimizer.audit_buckets()
         if args.output:
             optimizer.export_to_csv(results, args.output)
+        else:
+            deque(results, maxlen=0)  # Run the audit for its console report
     
     elif args.mode == 'apply':
-        print("Apply mode not yet implemented")
+        if args.bucket:
+            try:
+                result = optimizer.audit_bucket(args.bucket)
+            except Exception as e:
+                logger.error(f"❌ Could not analyze {args.bucket}: {e}")
+                return
+            recommendations = [(args.bucket, result['recommendation'])] if result['recommendation'] else []
+        else:
+            recommendations = [
+                (row.bucket_name, TEMPLATES_BY_STRATEGY[row.recommendation])
+                for row in optimizer.audit_buckets(use_cache=False)
+                if row.recommendation in TEMPLATES_BY_STRATEGY
+            ]
+        if not recommendations:
+            logger.info("\nNo buckets to apply lifecycle policies to")
+            return
+        optimizer.apply_all(recommendations, dry_run=args.dry_run)
 
 if __name__ == '__main__':
     main()
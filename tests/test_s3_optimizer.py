@@ -0,0 +1,123 @@
+"""Tests for S3LifecycleOptimizer against stubbed AWS clients"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import yaml
+from botocore.stub import Stubber
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import s3_optimizer  # noqa: E402
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'config.yaml')
+
+
+class OptimizerTestCase(unittest.TestCase):
+    def setUp(self):
+        for name, value in (('AWS_DEFAULT_REGION', 'us-east-1'),
+                            ('AWS_ACCESS_KEY_ID', 'testing'),
+                            ('AWS_SECRET_ACCESS_KEY', 'testing')):
+            os.environ.setdefault(name, value)
+        
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        with open(CONFIG_FILE) as f:
+            config = yaml.safe_load(f)
+        config['cache']['path'] = os.path.join(self.tmpdir, 'cache.db')
+        config_file = os.path.join(self.tmpdir, 'config.yaml')
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(config, f)
+        
+        self.optimizer = s3_optimizer.S3LifecycleOptimizer(config_file)
+        self.s3 = Stubber(self.optimizer.s3_client)
+        self.s3.activate()
+        self.addCleanup(self.s3.deactivate)
+    
+    def stub_no_lifecycle(self, bucket_name):
+        self.s3.add_client_error(
+            'get_bucket_lifecycle_configuration',
+            service_error_code='NoSuchLifecycleConfiguration',
+            http_status_code=404,
+            expected_params={'Bucket': bucket_name}
+        )
+
+
+class RequestBucketLifecycleTest(OptimizerTestCase):
+    def test_missing_configuration_is_none(self):
+        self.stub_no_lifecycle('b1')
+        self.assertIsNone(self.optimizer._request_bucket_lifecycle('b1'))
+        self.s3.assert_no_pending_responses()
+    
+    def test_other_errors_propagate(self):
+        self.s3.add_client_error(
+            'get_bucket_lifecycle_configuration',
+            service_error_code='AccessDenied',
+            http_status_code=403
+        )
+        with self.assertRaises(self.optimizer.s3_client.exceptions.ClientError):
+            self.optimizer._request_bucket_lifecycle('b1')
+
+
+
+class ApplyTest(OptimizerTestCase):
+    def test_dry_run_checks_but_does_not_write(self):
+        self.stub_no_lifecycle('b1')
+        results = self.optimizer.apply_all([('b1', s3_optimizer.GENERAL_RECOMMENDATION)])
+        self.assertEqual(results, [('b1', True, None)])
+        self.s3.assert_no_pending_responses()
+    
+    def test_writes_bucket_without_lifecycle(self):
+        policy = self.optimizer.generate_lifecycle_policy(s3_optimizer.GENERAL_RECOMMENDATION)
+        self.stub_no_lifecycle('b1')
+        self.s3.add_response(
+            'put_bucket_lifecycle_configuration', {},
+            expected_params={'Bucket': 'b1', 'LifecycleConfiguration': policy}
+        )
+        results = self.optimizer.apply_all(
+            [('b1', s3_optimizer.GENERAL_RECOMMENDATION)], dry_run=False
+        )
+        self.assertEqual(results, [('b1', True, None)])
+        self.s3.assert_no_pending_responses()
+    
+    def test_never_replaces_existing_lifecycle(self):
+        self.s3.add_response(
+            'get_bucket_lifecycle_configuration',
+            {'Rules': [{'ID': 'existing', 'Status': 'Enabled', 'Filter': {'Prefix': ''}}]},
+            expected_params={'Bucket': 'b1'}
+        )
+        result = self.optimizer.apply_lifecycle_policy('b1', {'Rules': []}, dry_run=False)
+        self.assertEqual(result, (False, 'LifecycleAlreadyConfigured'))
+        self.s3.assert_no_pending_responses()
+    
+    def test_failed_check_is_not_written(self):
+        self.s3.add_client_error(
+            'get_bucket_lifecycle_configuration',
+            service_error_code='AccessDenied',
+            http_status_code=403
+        )
+        result = self.optimizer.apply_lifecycle_policy('b1', {'Rules': []}, dry_run=False)
+        self.assertEqual(result, (False, 'AccessDenied'))
+        self.s3.assert_no_pending_responses()
+    
+    def test_audit_single_bucket(self):
+        self.s3.add_response(
+            'head_bucket', {'BucketRegion': 'us-east-1'}, expected_params={'Bucket': 'app-logs'}
+        )
+        self.stub_no_lifecycle('app-logs')
+        with Stubber(self.optimizer.cloudwatch) as cloudwatch:
+            cloudwatch.add_response('get_metric_data', {'MetricDataResults': [
+                {'Id': 's0', 'Values': [10 * 1024 ** 3]},
+                {'Id': 'o0', 'Values': [100]}
+            ]})
+            result = self.optimizer.audit_bucket('app-logs')
+        
+        self.assertEqual(result['recommendation']['strategy'], 'Intelligent-Tiering + Glacier')
+        self.assertEqual(result['object_count'], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()